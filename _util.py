@@ -15,7 +15,7 @@ def get_data_module_choices():
     return choices
 
 
-def get_datamodule(dataset_name: str, batch_size: int = 32):
+def get_datamodule(dataset_name: str, batch_size: int = 32, num_workers: int = 16):
     if dataset_name not in get_data_module_choices():
         raise ValueError(f"Unknown dataset name {dataset_name}")
     """Create dataset with given name, e.g. crossdocked_filtered or pdbbind_filtered_full"""
@@ -63,6 +63,7 @@ def get_datamodule(dataset_name: str, batch_size: int = 32):
         batch_size=batch_size,
         val_batch_size=32,
         test_batch_size=32,
+        num_workers=num_workers,
     )
     return dataset
 
@@ -5,51 +5,105 @@ Checks bond counts, inter-atomic distances, and model architecture.
 """
 
 import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import numpy as np
 from rdkit import Chem
-import torch
+from scipy import spatial
 
 
-def analyze_sdf_file(sdf_path):
-    """Analyze a single SDF file for connectivity issues."""
-    mol = Chem.MolFromMolFile(str(sdf_path), sanitize=False, removeHs=False)
-    
-    if mol is None:
-        return None
-    
+def distance_statistics(positions):
+    """Return (close_pairs, min_distance, mean_distance) over all atom pairs."""
+    distances = spatial.distance.pdist(positions)
+    # Typical bond lengths are 1.0-2.0 Å for most organic bonds
+    # OpenBabel uses similar thresholds
+    close_pairs = int(np.count_nonzero(distances < 2.0))
+    return close_pairs, float(distances.min()), float(distances.mean())
+
+
+def analyze_molecule(mol, name):
+    """Analyze a single molecule for connectivity issues."""
     num_atoms = mol.GetNumAtoms()
     num_bonds = mol.GetNumBonds()
     
-    # Calculate pairwise distances
-    conf = mol.GetConformer()
-    positions = np.array([conf.GetAtomPosition(i) for i in range(num_atoms)])
-    
-    # Compute distance matrix
-    distances = np.linalg.norm(positions[:, None, :] - positions[None, :, :], axis=2)
-    
-    # Typical bond lengths are 1.0-2.0 Å for most organic bonds
-    # OpenBabel uses similar thresholds
-    close_pairs = np.sum(np.triu(distances < 2.0, k=1))  # Upper triangle, exclude diagonal
+    # Calculate pairwise distances (condensed upper triangle, no self-distances).
+    # Degenerate molecules (fewer than two atoms or no conformer) have no pairs.
+    if num_atoms < 2 or mol.GetNumConformers() == 0:
+        close_pairs, min_distance, mean_distance = 0, float('nan'), float('nan')
+    else:
+        positions = np.asarray(mol.GetConformer().GetPositions(), dtype=np.float32)
+        close_pairs, min_distance, mean_distance = distance_statistics(positions)
     
     # Get atom types
-    atom_types = [atom.GetSymbol() for atom in mol.GetAtoms()]
+    atom_types = tuple(atom.GetSymbol() for atom in mol.GetAtoms())
     
     return {
-        'filename': sdf_path.name,
+        'filename': name,
         'num_atoms': num_atoms,
         'num_bonds': num_bonds,
         'close_pairs': close_pairs,  # Atoms within bonding distance
         'connectivity_ratio': num_bonds / max(num_atoms - 1, 1),  # Should be ~1.0 for connected
         'atom_types': atom_types,
-        'min_distance': np.min(distances[distances > 0]),  # Exclude self-distances
-        'mean_distance': np.mean(distances[np.triu_indices_from(distances, k=1)]),
+        'min_distance': min_distance,
+        'mean_distance': mean_distance,
     }
 
 
+def analyze_sdf_file(sdf_path):
+    """Analyze every molecule in an SDF file for connectivity issues."""
+    supplier = Chem.SDMolSupplier(str(sdf_path), sanitize=False, removeHs=False)
+    num_records = len(supplier)
+    
+    results = []
+    for i, mol in enumerate(supplier):
+        if mol is None:
+            continue
+        # Multi-molecule files are reported as filename#index of the record
+        name = sdf_path.name if num_records == 1 else f"{sdf_path.name}#{i}"
+        results.append(analyze_molecule(mol, name))
+    return results
+
+
+def count_atoms_and_bonds(sdf_path):
+    """Read atom and bond counts from the SDF counts lines without building molecules."""
+    records = []
+    for i, record in enumerate(sdf_path.read_bytes().split(b"$$$$")):
+        if i > 0:
+            # Drop the remainder of the preceding $$$$ line
+            record = record.split(b"\n", 1)[1] if b"\n" in record else b""
+        if record.strip():
+            records.append(record)
+
+    name = sdf_path.name
+    results = []
+    for i, record in enumerate(records):
+        lines = record.splitlines()
+        try:
+            counts_line = lines[3]
+            if b"V3000" in counts_line:
+                counts_line = next(line for line in lines if line.startswith(b"M  V30 COUNTS"))
+                num_atoms, num_bonds = (int(v) for v in counts_line.split()[3:5])
+            else:
+                # MDL V2000 counts line: aaabbb...
+                num_atoms, num_bonds = int(counts_line[0:3]), int(counts_line[3:6])
+        except (IndexError, ValueError, StopIteration):
+            # Skip unreadable records, as the RDKit path does
+            continue
+        results.append({
+            'filename': name if len(records) == 1 else f"{name}#{i}",
+            'num_atoms': num_atoms,
+            'num_bonds': num_bonds,
+            'connectivity_ratio': num_bonds / max(num_atoms - 1, 1),
+        })
+    return results
+
+
 def check_model_architecture(checkpoint_path):
     """Check which architecture the model uses."""
     try:
+        import torch
+
         # Add safe globals
         from diffusion_hopping.model.enum import Architecture, Parametrization, SamplingMode
         from diffusion_hopping.data.featurization import ProteinLigandSimpleFeaturization
@@ -83,6 +137,8 @@ def main():
     parser = argparse.ArgumentParser(description='Diagnose molecular connectivity issues')
     parser.add_argument('--results_dir', type=str, required=True, help='Directory containing generated SDF files')
     parser.add_argument('--checkpoint', type=str, help='Path to model checkpoint (optional)')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count(), help='Number of processes used to analyze SDF files')
+    parser.add_argument('--bonds_only', action='store_true', help='Only read atom/bond counts from the SDF headers, skipping RDKit parsing and distance statistics')
     args = parser.parse_args()
     
     results_dir = Path(args.results_dir)
@@ -100,22 +156,32 @@ def main():
     
     print(f"Analyzing {len(sdf_files)} SDF files...\n")
     
-    results = []
-    for sdf_file in sdf_files:
-        result = analyze_sdf_file(sdf_file)
-        if result:
-            results.append(result)
+    analyze = count_atoms_and_bonds if args.bonds_only else analyze_sdf_file
+    
+    # Files are independent, so parse them in parallel
+    with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+        results = [
+            result
+            for file_results in executor.map(analyze, sdf_files, chunksize=16)
+            for result in file_results
+        ]
     
     # Print summary
     print("=" * 80)
     print("CONNECTIVITY ANALYSIS")
     print("=" * 80)
-    print(f"{'Filename':<20} {'Atoms':>6} {'Bonds':>6} {'Close Pairs':>12} {'Conn. Ratio':>12} {'Min Dist':>10}")
+    if args.bonds_only:
+        print(f"{'Filename':<20} {'Atoms':>6} {'Bonds':>6} {'Conn. Ratio':>12}")
+    else:
+        print(f"{'Filename':<20} {'Atoms':>6} {'Bonds':>6} {'Close Pairs':>12} {'Conn. Ratio':>12} {'Min Dist':>10}")
     print("-" * 80)
     
     for r in results:
-        print(f"{r['filename']:<20} {r['num_atoms']:>6} {r['num_bonds']:>6} {r['close_pairs']:>12} "
-              f"{r['connectivity_ratio']:>12.2f} {r['min_distance']:>10.3f}")
+        if args.bonds_only:
+            print(f"{r['filename']:<20} {r['num_atoms']:>6} {r['num_bonds']:>6} {r['connectivity_ratio']:>12.2f}")
+        else:
+            print(f"{r['filename']:<20} {r['num_atoms']:>6} {r['num_bonds']:>6} {r['close_pairs']:>12} "
+                  f"{r['connectivity_ratio']:>12.2f} {r['min_distance']:>10.3f}")
     
     # Statistics
     bond_counts = [r['num_bonds'] for r in results]
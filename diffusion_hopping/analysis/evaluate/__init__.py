@@ -1,5 +1,7 @@
+import copy
 import functools
 import itertools
+import os
 import shutil
 from pathlib import Path
 from typing import List
@@ -74,6 +76,16 @@ class Evaluator(object):
     def load_model(self, model):
         self.model = model
 
+    def scoring_copy(self) -> "Evaluator":
+        # Shares the data module, metrics and model, so that the training set
+        # is not walked again for Novelty, but keeps its own output; used to
+        # evaluate finished samples while this evaluator generates more
+        evaluator = copy.copy(self)
+        evaluator._metric_columns = list(self._metric_columns)
+        evaluator._output = None
+        evaluator._mode = None
+        return evaluator
+
     def generate_molecules(
         self, molecules_per_pocket=3, batch_size=32, limit_samples=None
     ):
@@ -243,11 +255,12 @@ class Evaluator(object):
 
     def calculate_qvina_scores(self):
         print("Calculating QVina scores...")
-        # Increase parallelization for faster QVina scoring
+        # Run one single-core QVina process per CPU rather than a few
+        # multi-threaded ones, as QVina scales poorly beyond a handful of cores
         scores = thread_map(
-            lambda iterrows: qvina_score(iterrows[1]), 
+            lambda iterrows: qvina_score(iterrows[1], cpu=1),
             list(self._output.iterrows()),
-            max_workers=32,  # Increased parallelization
+            max_workers=os.cpu_count(),
         )
         self._output["QVina"] = scores
         if "QVina" not in self._metric_columns:
@@ -280,7 +293,7 @@ class Evaluator(object):
 
         return results_list
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def _generate_molecule(self, batch):
         batch = batch.to(self.model.device)
         sample_results = self.model.model.sample(batch)
@@ -288,7 +301,7 @@ class Evaluator(object):
         molecules = self.molecule_builder(final_output)
         return molecules
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def _generate_molecule_inpaint(self, batch, j=10, r=10) -> List[Chem.Mol]:
         batch = batch.to(self.model.device)
         mask = batch["ligand"].scaffold_mask
@@ -381,7 +394,7 @@ class Evaluator(object):
             self._store_molecule(
                 row["molecule"], row["molecule_path"], transform=transform
             )
-            qvina_score(row)
+            qvina_score(row, output_dir=output_path)
 
         to_html(
             output.drop(columns=["test_set_item"]),
@@ -1,92 +1,183 @@
+import contextlib
+import hashlib
+import os
+import re
 import subprocess
+import tempfile
+import threading
+from collections import defaultdict
 from pathlib import Path
 
-from diffusion_hopping.analysis.evaluate.util import _run_commands
+from meeko import MoleculePreparation, PDBQTWriterLegacy
 
+# Many rows share a protein and are scored concurrently; serialize receptor
+# preparation per protein so that no thread reads a half-written PDBQT file
+_protein_locks = defaultdict(threading.Lock)
 
-def qvina_score(row, size=20.0, exhaustiveness=16):
+# First row of the results table printed by QVina, i.e. the best mode
+_QVINA_RESULT_RE = re.compile(
+    r"^-----\+-+\+-+\+-+[ \t]*\r?\n\s*1\s+([-+]?\d+(?:\.\d+)?)", re.MULTILINE
+)
+
+
+def qvina_score(row, size=20.0, exhaustiveness=8, cpu=None, output_dir=None):
+    """Dock row["molecule"] into its pocket with QVina and return the best score.
+
+    exhaustiveness sets the number of Monte Carlo chains and dominates the
+    runtime. The Vina default of 8 gives stable scores for re-docking into a
+    known pocket; raise it for a more thorough (and slower) search.
+
+    The prepared ligand and the docked poses are written to output_dir. If it
+    is None, they go to a temporary directory that is removed afterwards.
+    """
     try:
         if row["molecule"] is None:
             return None
         protein_pdbqt = _prepare_protein(row["test_set_item"]["protein"].path)
-        ligand_pdbqt = _prepare_ligand(row["molecule_path"])
-        return _calculate_qvina_score(
-            protein_pdbqt,
-            ligand_pdbqt,
-            row["molecule"],
-            size=size,
-            exhaustiveness=exhaustiveness,
-        )
+        if output_dir is None:
+            work_dir_context = tempfile.TemporaryDirectory(dir=_scratch_root())
+        else:
+            work_dir_context = contextlib.nullcontext(output_dir)
+        with work_dir_context as work_dir:
+            work_dir = Path(work_dir)
+            ligand_pdbqt = _prepare_ligand(row["molecule_path"], work_dir)
+            return _calculate_qvina_score(
+                protein_pdbqt,
+                ligand_pdbqt,
+                row["molecule"],
+                work_dir / f"{ligand_pdbqt.stem}_out.pdbqt",
+                size=size,
+                exhaustiveness=exhaustiveness,
+                cpu=cpu,
+            )
     except:
         return None
 
 
 def _prepare_protein(protein_path) -> Path:
-    protein_folder = protein_path.parent.resolve()
-    protein_name = protein_path.name
-    protein_pdbqt = f"{protein_path.stem}.pdbqt"
-    protein_pdbqt = protein_folder / protein_pdbqt
-
-    # Use meeko instead of MGLTools
-    # -p flag writes PDBQT output
-    commands = [
-        f"cd {protein_folder}",
-        f"mk_prepare_receptor.py -i {protein_name} -o {protein_path.stem} -p",
-    ]
-    _run_commands(commands)
+    protein_path = protein_path.resolve()
+    # Key the persistent cache on the pocket contents rather than on its path
+    # and mtime, so that re-extracted or edited datasets are never matched
+    # with a stale receptor
+    digest = hashlib.sha1(protein_path.read_bytes()).hexdigest()[:16]
+    scratch = _scratch_root()
+    protein_pdbqt = scratch / f"{protein_path.stem}_{digest}.pdbqt"
+
+    with _protein_locks[protein_pdbqt]:
+        if protein_pdbqt.exists():
+            return protein_pdbqt
+
+        # meeko writes to a temporary basename that is moved into place only
+        # on success, so a failed or interrupted run leaves no partial file
+        # behind that later calls would take for a prepared receptor
+        tmp_stem = f"{protein_pdbqt.stem}.{os.getpid()}.tmp"
+        tmp_pdbqt = scratch / f"{tmp_stem}.pdbqt"
+        # Use meeko instead of MGLTools
+        # -p flag writes PDBQT output
+        command = [
+            "mk_prepare_receptor.py",
+            "-i",
+            str(protein_path),
+            "-o",
+            tmp_stem,
+            "-p",
+        ]
+        try:
+            # stderr is only decoded if it is needed for the error message
+            result = subprocess.run(
+                command,
+                cwd=scratch,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+            )
+            if result.returncode != 0:
+                raise RuntimeError(
+                    f"mk_prepare_receptor.py returned non-zero return code {result.returncode} when running '{' '.join(command)}': "
+                    f"{result.stderr.decode('utf-8', errors='replace')}"
+                )
+            os.replace(tmp_pdbqt, protein_pdbqt)
+        finally:
+            tmp_pdbqt.unlink(missing_ok=True)
     return protein_pdbqt
 
 
-def _prepare_ligand(ligand_path) -> Path:
+def _prepare_ligand(ligand_path, output_dir: Path) -> Path:
     from rdkit import Chem
-    
-    ligand_folder = ligand_path.parent.resolve()
-    ligand_name = ligand_path.name
-    ligand_pdbqt = f"{ligand_path.stem}.pdbqt"
-    ligand_pdbqt = ligand_folder / ligand_pdbqt
-
-    # meeko's mk_prepare_ligand doesn't support PDB, so convert to SDF first
-    ligand_sdf = ligand_folder / f"{ligand_path.stem}.sdf"
-    
-    # Convert PDB to SDF using RDKit and add explicit hydrogens
+
+    ligand_path = ligand_path.resolve()
+    ligand_pdbqt = output_dir / f"{ligand_path.stem}.pdbqt"
+    if _is_up_to_date(ligand_pdbqt, ligand_path):
+        return ligand_pdbqt
+
     mol = Chem.MolFromPDBFile(str(ligand_path), removeHs=False)
-    if mol is not None:
-        # Add explicit hydrogens (required by meeko)
-        mol = Chem.AddHs(mol, addCoords=True)
-        Chem.MolToMolFile(mol, str(ligand_sdf))
-    else:
-        # If RDKit fails, just copy the PDB and hope meeko can handle it
-        ligand_sdf = ligand_path
-    
-    # Use meeko instead of MGLTools
-    commands = [
-        f"cd {ligand_folder}",
-        f"mk_prepare_ligand.py -i {ligand_sdf.name} -o {ligand_pdbqt.name}",
-    ]
-    _run_commands(commands)
+    if mol is None:
+        raise RuntimeError(f"RDKit could not read ligand {ligand_path}")
+    # Add explicit hydrogens (required by meeko)
+    mol = Chem.AddHs(mol, addCoords=True)
+
+    # Run meeko in-process rather than round-tripping through an SDF file
+    # and the mk_prepare_ligand.py script
+    mol_setups = MoleculePreparation().prepare(mol)
+    pdbqt_string, is_ok, error_msg = PDBQTWriterLegacy.write_string(mol_setups[0])
+    if not is_ok:
+        raise RuntimeError(f"meeko failed to prepare {ligand_path}: {error_msg}")
+    ligand_pdbqt.write_text(pdbqt_string)
     return ligand_pdbqt
 
 
+def _scratch_root() -> Path:
+    # Keep docking intermediates on tmpfs instead of next to the (possibly
+    # networked) dataset
+    default_root = (
+        Path("/dev/shm/docking")
+        if Path("/dev/shm").is_dir()
+        else Path(tempfile.gettempdir()) / "docking"
+    )
+    root = Path(os.environ.get("DOCKING_SCRATCH", default_root))
+    root.mkdir(parents=True, exist_ok=True)
+    return root
+
+
+def _is_up_to_date(target: Path, source: Path) -> bool:
+    return target.exists() and target.stat().st_mtime >= source.stat().st_mtime
+
+
 def _calculate_qvina_score(
-    protein_path, ligand_path, mol, size=20.0, exhaustiveness=16
+    protein_path, ligand_path, mol, out_path, size=20.0, exhaustiveness=8, cpu=None
 ) -> float:
     center = mol.GetConformer().GetPositions().mean(axis=0)
-    command = f"qvina2.1 --receptor {protein_path.resolve()} --ligand {ligand_path.resolve()} --center_x {center[0]} --center_y {center[1]} --center_z {center[2]} --size_x {size} --size_y {size} --size_z {size} --exhaustiveness {exhaustiveness} "
-    result = subprocess.run(
-        command, shell=True, stdout=subprocess.PIPE, encoding="utf-8"
-    )
+    command = [
+        "qvina2.1",
+        "--receptor",
+        str(protein_path.resolve()),
+        "--ligand",
+        str(ligand_path.resolve()),
+        "--out",
+        str(out_path.resolve()),
+        "--center_x",
+        f"{center[0]:.3f}",
+        "--center_y",
+        f"{center[1]:.3f}",
+        "--center_z",
+        f"{center[2]:.3f}",
+        "--size_x",
+        str(size),
+        "--size_y",
+        str(size),
+        "--size_z",
+        str(size),
+        "--exhaustiveness",
+        str(exhaustiveness),
+    ]
+    if cpu is not None:
+        command += ["--cpu", str(cpu)]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     if result.returncode != 0:
         raise RuntimeError(
-            f"QVina returned non-zero return code {result.returncode} when running '{command}'"
+            f"QVina returned non-zero return code {result.returncode} when running '{' '.join(command)}': "
+            f"{result.stderr.decode('utf-8', errors='replace')}"
         )
-    out_lines = iter(result.stdout.splitlines())
-    for line in out_lines:
-        if line.startswith("-----+------------+----------+----------"):
-            break
-
-    relevant_line = next(out_lines)
-    # print("Identified line", relevant_line)
-    if relevant_line.split()[0] != "1":
+    match = _QVINA_RESULT_RE.search(result.stdout.decode("utf-8"))
+    if match is None:
         raise RuntimeError("No valid result found")
-    score = float(relevant_line.split()[1])
-    return score
+    return float(match.group(1))
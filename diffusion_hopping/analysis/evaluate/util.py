@@ -1,7 +1,5 @@
 import base64
-import subprocess
 from io import BytesIO
-from typing import List
 
 from PIL import Image
 from rdkit import Chem
@@ -48,27 +46,6 @@ def _to_smiles_image(row):
         return None
 
 
-def _run_commands(commands: List[str]) -> str:
-    commands = "\n".join(commands)
-    # execute command in shell
-    proc = subprocess.Popen(
-        "/bin/bash",
-        shell=False,
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    proc.stdin.write(commands.encode("utf-8"))
-    proc.stdin.close()
-    result = proc.wait()
-
-    if result != 0:
-        raise RuntimeError(
-            f"_run_commands return code {result} when running '{commands}'"
-        )
-    return "\n".join([line.decode("utf-8") for line in proc.stdout.readlines()])
-
-
 def image_base64(im):
     with BytesIO() as buffer:
         im.save(buffer, "jpeg")
@@ -15,6 +15,7 @@ class CrossDockedDataModule(ProteinLigandComplexDataModule):
         val_batch_size=None,
         shuffle=True,
         overfit_item=False,
+        num_workers=16,
     ) -> None:
         super().__init__(
             batch_size=batch_size,
@@ -22,6 +23,7 @@ class CrossDockedDataModule(ProteinLigandComplexDataModule):
             val_batch_size=val_batch_size,
             shuffle=shuffle,
             overfit_item=overfit_item,
+            num_workers=num_workers,
         )
         self.root = root
         self.pre_transform = pre_transform
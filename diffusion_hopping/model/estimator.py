@@ -151,7 +151,13 @@ class EstimatorModel(nn.Module):
         x_final_ligand = self.atom_decoder(x_final[: len(batch_ligand)])
         pos_out_ligand = pos_out[: len(batch_ligand)]
 
-        return x_final_ligand[ligand_mask], pos_out_ligand[ligand_mask]
+        # Under autocast the decoder and coordinate outputs may come back in a
+        # lower precision; the sampler writes them into the fp32 diffusion
+        # state, which requires matching dtypes
+        return (
+            x_final_ligand[ligand_mask].to(x_t["ligand"].x.dtype),
+            pos_out_ligand[ligand_mask].to(pos_ligand.dtype),
+        )
 
     def get_edges(self, batch_mask, x, is_protein):
         is_ligand = ~is_protein
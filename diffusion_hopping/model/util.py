@@ -1,16 +1,39 @@
 import torch
 import torch.nn as nn
-import torch_scatter
 
+try:
+    from torch_scatter import scatter_mean as _scatter_mean_fast
+except ImportError:
+    _scatter_mean_fast = None
 
-def centered_batch(x, batch, mask=None, dim_size=None):
+
+def scatter_mean(src, index, dim_size=None, mask=None):
+    """Mean of the rows of src grouped by index along dim 0.
+
+    If mask is given, only rows where mask is set contribute to the mean.
+    """
+    if mask is None and _scatter_mean_fast is not None and src.is_cuda:
+        return _scatter_mean_fast(src, index, dim=0, dim_size=dim_size)
+    if dim_size is None:
+        dim_size = int(index.max()) + 1 if index.numel() > 0 else 0
     if mask is None:
-        mean = torch_scatter.scatter_mean(x, batch, dim=0)
+        count = torch.bincount(index, minlength=dim_size)
     else:
-        mean = torch_scatter.scatter_mean(
-            x[mask], batch[mask], dim=0, dim_size=dim_size
-        )
-    return x - mean[batch]
+        # Zero out masked rows rather than gathering the unmasked ones; unlike
+        # a multiply, masked_fill also keeps NaN or inf in them out of the mean
+        src = src.masked_fill(~mask.view(-1, *([1] * (src.dim() - 1))), 0)
+        count = index.new_zeros(dim_size).index_add_(0, index, mask.to(index.dtype))
+    out = src.new_zeros((dim_size, *src.shape[1:]))
+    out.index_add_(0, index, src)
+    count = count.clamp_(min=1).view(-1, *([1] * (src.dim() - 1)))
+    if out.is_floating_point():
+        return out / count
+    return out.div_(count, rounding_mode="floor")
+
+
+def centered_batch(x, batch, mask=None, dim_size=None):
+    mean = scatter_mean(x, batch, dim_size=dim_size, mask=mask)
+    return x - torch.index_select(mean, 0, batch)
 
 
 def skip_computation_on_oom(return_value=None, error_message=None):
@@ -1,6 +1,9 @@
 import argparse
+import contextlib
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import List
 
 import torch
 import pandas as pd
@@ -24,6 +27,28 @@ torch.serialization.add_safe_globals([
 ])
 
 
+MODE_LABELS = {
+    "ground_truth": "Ground truth",
+    "ligand_generation": "Ligand generation",
+    "inpaint_generation": "Inpaint generation",
+}
+
+
+def selected_modes(mode: str, is_repainting_compatible: bool) -> List[str]:
+    modes = []
+    if (
+        mode == "ground_truth"
+        or mode == "all"
+        or (mode == "inpaint_generation" and is_repainting_compatible)
+    ):
+        modes.append("ground_truth")
+    if mode == "ligand_generation" or mode == "all":
+        modes.append("ligand_generation")
+    if mode == "inpaint_generation" or (mode == "all" and is_repainting_compatible):
+        modes.append("inpaint_generation")
+    return modes
+
+
 def generate_molecules(
     evaluator: Evaluator,
     output_path: Path,
@@ -33,84 +58,147 @@ def generate_molecules(
     limit_samples: int = None,
     molecules_per_pocket: int = 100,
     batch_size: int = 32,
+    precision: str = "fp32",
 ):
     is_repainting_compatible = evaluator.is_model_repainting_compatible()
-    if (
-        mode == "ground_truth"
-        or mode == "all"
-        or (mode == "inpaint_generation" and is_repainting_compatible)
-    ):
-        print("Generating ground truth molecules...")
-        evaluator.use_ground_truth_molecules(limit_samples=limit_samples)
-        evaluator.to_tensor(output_path / "molecules_ground_truth.pt")
-
-    if mode == "ligand_generation" or mode == "all":
-        print("Generating ligand molecules...")
-        evaluator.generate_molecules(
-            limit_samples=limit_samples,
-            molecules_per_pocket=molecules_per_pocket,
-            batch_size=batch_size,
-        )
-        evaluator.to_tensor(output_path / "molecules_ligand_generation.pt")
-
-    if mode == "inpaint_generation" or (mode == "all" and is_repainting_compatible):
-        print(f"Generating inpaint molecules with r={r}, j={j}...")
-        evaluator.generate_molecules_inpainting(
+    for generation_mode in selected_modes(mode, is_repainting_compatible):
+        _generate_molecules_for_mode(
+            evaluator,
+            output_path,
+            generation_mode,
             r=r,
             j=j,
             limit_samples=limit_samples,
             molecules_per_pocket=molecules_per_pocket,
             batch_size=batch_size,
+            precision=precision,
         )
-        evaluator.to_tensor(output_path / "molecules_inpaint_generation.pt")
+
+
+def _generate_molecules_for_mode(
+    evaluator: Evaluator,
+    output_path: Path,
+    mode: str,
+    r: int = 10,
+    j: int = 10,
+    limit_samples: int = None,
+    molecules_per_pocket: int = 100,
+    batch_size: int = 32,
+    precision: str = "fp32",
+):
+    with sampling_context(precision):
+        if mode == "ground_truth":
+            print("Generating ground truth molecules...")
+            evaluator.use_ground_truth_molecules(limit_samples=limit_samples)
+        elif mode == "ligand_generation":
+            print("Generating ligand molecules...")
+            evaluator.generate_molecules(
+                limit_samples=limit_samples,
+                molecules_per_pocket=molecules_per_pocket,
+                batch_size=batch_size,
+            )
+        elif mode == "inpaint_generation":
+            print(f"Generating inpaint molecules with r={r}, j={j}...")
+            evaluator.generate_molecules_inpainting(
+                r=r,
+                j=j,
+                limit_samples=limit_samples,
+                molecules_per_pocket=molecules_per_pocket,
+                batch_size=batch_size,
+            )
+        else:
+            raise ValueError(f"Unknown mode: {mode}")
+    evaluator.to_tensor(output_path / f"molecules_{mode}.pt")
+
+
+@contextlib.contextmanager
+def sampling_context(precision: str):
+    with torch.inference_mode():
+        if precision == "bf16":
+            # Weights stay in fp32; autocast runs the matmuls in bf16 and the
+            # estimator casts its outputs back, so the diffusion state itself
+            # is kept in fp32 for every parametrization
+            with torch.autocast(device_type="cuda", dtype=torch.bfloat16):
+                yield
+        else:
+            yield
 
 
 def evaluate_molecules(evaluator, output_path, mode="all"):
     is_repainting_compatible = evaluator.is_model_repainting_compatible()
     output_str = f"Output path: {output_path}\n"
-    if (
-        mode == "ground_truth"
-        or mode == "all"
-        or (mode == "inpaint_generation" and is_repainting_compatible)
-    ):
-        print("Running ground truth evaluation...")
-        evaluator.from_tensor(output_path / "molecules_ground_truth.pt")
-        evaluator.evaluate(transform_for_qvina=False)
-        evaluator.to_html(output_path / "results_ground_truth.html")
-        evaluator.to_tensor(output_path / "results_ground_truth.pt")
-        evaluator.print_summary_statistics()
-        output_str += f"Ground truth results: \n{evaluator.get_summary_string()}\n"
+    for evaluation_mode in selected_modes(mode, is_repainting_compatible):
+        output_str += _evaluate_molecules_for_mode(
+            evaluator, output_path, evaluation_mode
+        )
 
-    if mode == "ligand_generation" or mode == "all":
-        print("Running ligand generation evaluation...")
-        evaluator.from_tensor(output_path / "molecules_ligand_generation.pt")
-        evaluator.evaluate(transform_for_qvina=True)
-        evaluator.to_html(output_path / "results_ligand_generation.html")
-        evaluator.to_tensor(output_path / "results_ligand_generation.pt")
-        evaluator.print_summary_statistics()
-        output_str += f"Ligand generation results: \n{evaluator.get_summary_string()}\n"
+    output_path.joinpath("summary.txt").write_text(output_str)
+
+
+def _evaluate_molecules_for_mode(evaluator, output_path, mode) -> str:
+    label = MODE_LABELS[mode]
+    print(f"Running {label.lower()} evaluation...")
+    evaluator.from_tensor(output_path / f"molecules_{mode}.pt")
+    evaluator.evaluate(transform_for_qvina=(mode != "ground_truth"))
+    evaluator.to_html(output_path / f"results_{mode}.html")
+    evaluator.to_tensor(output_path / f"results_{mode}.pt")
+    evaluator.print_summary_statistics()
+    return f"{label} results: \n{evaluator.get_summary_string()}\n"
 
-    if mode == "inpaint_generation" or (mode == "all" and is_repainting_compatible):
-        print("Running inpaint generation evaluation...")
-        evaluator.from_tensor(output_path / "molecules_inpaint_generation.pt")
-        evaluator.evaluate(transform_for_qvina=True)
-        evaluator.to_html(output_path / "results_inpaint_generation.html")
-        evaluator.to_tensor(output_path / "results_inpaint_generation.pt")
-        evaluator.print_summary_statistics()
-        output_str += (
-            f"Inpaint generation results: \n{evaluator.get_summary_string()}\n"
-        )
+
+def generate_and_evaluate_molecules(
+    evaluator: Evaluator,
+    scoring_evaluator: Evaluator,
+    output_path: Path,
+    mode: str = "all",
+    **generation_kwargs,
+):
+    """Generate molecules mode by mode and evaluate each finished mode in the
+    background while the next one is sampled.
+
+    Evaluation is dominated by QVina subprocesses, so it overlaps well with
+    sampling on the GPU. A separate evaluator is needed as Evaluator keeps
+    the molecules it works on as state.
+    """
+    is_repainting_compatible = evaluator.is_model_repainting_compatible()
+    output_str = f"Output path: {output_path}\n"
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        futures = []
+        for current_mode in selected_modes(mode, is_repainting_compatible):
+            _generate_molecules_for_mode(
+                evaluator, output_path, current_mode, **generation_kwargs
+            )
+            futures.append(
+                executor.submit(
+                    _evaluate_molecules_for_mode,
+                    scoring_evaluator,
+                    output_path,
+                    current_mode,
+                )
+            )
+        for future in futures:
+            output_str += future.result()
 
     output_path.joinpath("summary.txt").write_text(output_str)
 
 
-def setup_model_and_data_module(dataset_name, checkpoint_path, device="cpu"):
+def setup_model_and_data_module(
+    dataset_name, checkpoint_path, device="cpu", num_workers=16
+):
     print(f"Loading checkpoint from: {checkpoint_path}")
-    model = DiffusionHoppingModel.load_from_checkpoint(
-        checkpoint_path, map_location=device, weights_only=False
-    ).to(device)
+    # Memory-map the checkpoint and let the model adopt the mapped tensors
+    # (assign=True) instead of copying them into freshly initialised ones, so
+    # the only copy made is the final transfer to the target device
+    checkpoint = torch.load(
+        checkpoint_path, map_location="cpu", mmap=True, weights_only=False
+    )
+    model = DiffusionHoppingModel(**checkpoint["hyper_parameters"])
+    model.load_state_dict(checkpoint["state_dict"], assign=True)
+    model = model.to(device)
 
-    data_module = get_datamodule(dataset_name, batch_size=32)
+    data_module = get_datamodule(
+        dataset_name, batch_size=32, num_workers=num_workers
+    )
     return model, data_module
 
 
@@ -185,6 +273,19 @@ def main():
         help="Batch size for generation",
         default=32,
     )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        help="Precision used for sampling; bf16 requires a CUDA device with bf16 support",
+        choices=["fp32", "bf16"],
+        default="fp32",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        help="Number of worker processes for loading the test set",
+        default=min(os.cpu_count() or 1, 8),
+    )
     args = parser.parse_args()
 
     mode = args.mode
@@ -199,6 +300,12 @@ def main():
     checkpoint_path = args.checkpoint_path
 
     device = "cuda" if torch.cuda.is_available() else "cpu"
+    precision = args.precision
+    if precision == "bf16" and not (
+        device == "cuda" and torch.cuda.is_bf16_supported()
+    ):
+        print("bf16 is not supported on this device, falling back to fp32")
+        precision = "fp32"
 
     dataset_name = args.dataset
     output_path = Path("evaluation") / run_id / dataset_name
@@ -207,25 +314,32 @@ def main():
     disable_obabel_and_rdkit_logging()
 
     model, data_module = setup_model_and_data_module(
-        dataset_name, checkpoint_path, device=device
+        dataset_name, checkpoint_path, device=device, num_workers=args.num_workers
     )
 
     evaluator = Evaluator(output_path)
     evaluator.load_data_module(data_module)
     evaluator.load_model(model)
 
-    if do_generation:
-        generate_molecules(
+    generation_kwargs = dict(
+        r=r,
+        j=j,
+        limit_samples=limit_samples,
+        molecules_per_pocket=molecules_per_pocket,
+        batch_size=batch_size,
+        precision=precision,
+    )
+    if do_generation and do_evaluation:
+        generate_and_evaluate_molecules(
             evaluator,
+            evaluator.scoring_copy(),
             output_path,
             mode=mode,
-            r=r,
-            j=j,
-            limit_samples=limit_samples,
-            molecules_per_pocket=molecules_per_pocket,
-            batch_size=batch_size,
+            **generation_kwargs,
         )
-    if do_evaluation:
+    elif do_generation:
+        generate_molecules(evaluator, output_path, mode=mode, **generation_kwargs)
+    elif do_evaluation:
         evaluate_molecules(evaluator, output_path, mode=mode)
 
 
@@ -2,7 +2,29 @@ import unittest
 
 import torch
 
-from diffusion_hopping.model.util import centered_batch, skip_computation_on_oom
+from diffusion_hopping.model.util import (
+    centered_batch,
+    scatter_mean,
+    skip_computation_on_oom,
+)
+
+
+class TestScatterMean(unittest.TestCase):
+    def test_scatter_mean(self):
+        src = torch.tensor([[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]])
+        index = torch.tensor([0, 0, 1])
+
+        desired_output = torch.tensor([[2.0, 3.0], [5.0, 6.0]])
+        output = scatter_mean(src, index)
+        self.assertTrue(torch.allclose(output, desired_output))
+
+    def test_scatter_mean_with_empty_group(self):
+        src = torch.tensor([[1.0], [3.0]])
+        index = torch.tensor([0, 2])
+
+        desired_output = torch.tensor([[1.0], [0.0], [3.0], [0.0]])
+        output = scatter_mean(src, index, dim_size=4)
+        self.assertTrue(torch.allclose(output, desired_output))
 
 
 class TestCenteredBatch(unittest.TestCase):
@@ -24,6 +46,26 @@ class TestCenteredBatch(unittest.TestCase):
         output = centered_batch(x, batch, mask=mask)
         self.assertTrue(torch.allclose(output, desired_output))
 
+    def test_centered_batch_with_mask_and_empty_last_graph(self):
+        x = torch.tensor([[1, 2], [3, 4], [5, 6]])
+        batch = torch.tensor([0, 0, 1])
+        mask = torch.tensor([True, False, False])
+
+        desired_output = torch.tensor([[0, 0], [2, 2], [5, 6]])
+        output = centered_batch(x, batch, mask=mask)
+        self.assertTrue(torch.allclose(output, desired_output))
+
+    def test_centered_batch_with_nan_in_masked_row(self):
+        x = torch.tensor([[1.0, 2.0], [float("nan"), 4.0], [5.0, 6.0], [8.0, 9.0]])
+        batch = torch.tensor([0, 0, 1, 1])
+        mask = torch.tensor([True, False, True, False])
+
+        desired_output = torch.tensor(
+            [[0.0, 0.0], [float("nan"), 2.0], [0.0, 0.0], [3.0, 3.0]]
+        )
+        output = centered_batch(x, batch, mask=mask)
+        self.assertTrue(torch.allclose(output, desired_output, equal_nan=True))
+
 
 class TestSkipComputationOnOOM(unittest.TestCase):
     def test_skip_computation_on_oom(self):